@@ -5,14 +5,17 @@ Single-file application for PostgreSQL data exploration
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from urllib.parse import quote, unquote, urlparse, parse_qs
 import io
-import html
 import re
-import copy
-from datetime import datetime
+import hashlib
+import bisect
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 
 # =============================================================================
 # CONFIGURATION
@@ -21,6 +24,33 @@ MAX_ROWS = 10000
 MAX_EXPORT_ROWS = 50000
 QUERY_TIMEOUT_MS = 300000  # 5 minutes
 
+MAP_MAX_POINTS = 5000  # Upper bound on points plotted on the map
+
+# Map zoom: ascending coordinate-span thresholds (degrees) and the closest zoom level
+MAP_ZOOM_SPANS = (0.01, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100)
+MAP_MAX_ZOOM = 13
+
+# PostgreSQL type OIDs mapped to pandas dtypes for query results
+PG_TYPE_DTYPES = {
+    21: 'int16',          # int2
+    23: 'int32',          # int4
+    20: 'int64',          # int8
+    700: 'float64',       # float4 (float32 would distort values like 1.1 on export)
+    701: 'float64',       # float8
+    1114: 'datetime64[ns]',  # timestamp
+    1184: 'datetimetz',   # timestamptz (normalized to UTC)
+}
+
+# Result column type OIDs connectorx decodes the same way pg8000 does
+# (bool, int2/4/8, float8, text, varchar, bpchar). float4 comes back as float32,
+# date/timestamp 'infinity' values are mis-decoded, numeric, uuid, json and inet
+# are returned differently, and others (e.g. interval) are unsupported.
+CX_TYPE_OIDS = frozenset({16, 21, 23, 20, 701, 25, 1043, 1042})
+
+# Planner row estimate from which connectorx is used; below it a fresh connectorx
+# connection (and TLS handshake) costs more than decoding the rows with pg8000
+CX_MIN_ROWS = 5000
+
 st.set_page_config(
     page_title="IoT Query Probe",
     page_icon="",
@@ -54,13 +84,19 @@ st.markdown("""
 # =============================================================================
 # QUERY VALIDATION
 # =============================================================================
+# Precompiled patterns used for masking credentials in error messages
+_PG_URL_RE = re.compile(r'postgresql://[^\s]+')
+_PASSWORD_RE = re.compile(r'password[=:][^\s,]+', re.IGNORECASE)
+
+
 def validate_query(query: str) -> tuple[bool, str]:
     """
     Basic query validation.
     
     Returns: (is_valid, error_message)
     """
-    if not query or not query.strip():
+    # isspace() checks in place instead of building a stripped copy
+    if not query or query.isspace():
         return False, "Query cannot be empty"
     
     return True, ""
@@ -71,8 +107,8 @@ def sanitize_error(error: Exception) -> str:
     error_str = str(error)
     
     # Remove potential connection string details
-    error_str = re.sub(r'postgresql://[^\s]+', 'postgresql://***', error_str)
-    error_str = re.sub(r'password[=:][^\s,]+', 'password=***', error_str, flags=re.IGNORECASE)
+    error_str = _PG_URL_RE.sub('postgresql://***', error_str)
+    error_str = _PASSWORD_RE.sub('password=***', error_str)
     
     # Truncate long errors
     if len(error_str) > 200:
@@ -84,16 +120,31 @@ def sanitize_error(error: Exception) -> str:
 # =============================================================================
 # DATABASE CONNECTION
 # =============================================================================
+# Queries that can be wrapped as a subquery to push down the row limit
+_SELECT_RE = re.compile(r'\A\s*(?:select|with)\b', re.IGNORECASE)
+# Errors from a wrapped query that mean it can't be a subquery (e.g. SELECT ... INTO,
+# data-modifying CTEs, a trailing '; -- comment'): syntax_error, feature_not_supported
+_UNWRAPPABLE_SQLSTATES = {'42601', '0A000'}
+# DISCARD ALL inside an open transaction block: active_sql_transaction
+_IN_TRANSACTION_SQLSTATE = '25001'
+
+# Precompiled patterns for connection field validation (this runs on every rerun).
+# \Z rejects a trailing newline that $ would allow; [0-9] rejects non-ASCII digits
+# that str.isdigit() accepts.
+_HOST_RE = re.compile(r'\A[\w.\-]+\Z')
+_PORT_RE = re.compile(r'\A[0-9]+\Z')
+
+
 def build_connection_string(host: str, port: str, database: str, user: str, password: str) -> str:
     """Build PostgreSQL connection string from individual components."""
     # Validate inputs
-    if not all([host, port, database, user, password]):
+    if not (host and port and database and user and password):
         return ""
     
     # Basic input validation
-    if not re.match(r'^[\w\.\-]+$', host):
+    if not _HOST_RE.match(host):
         return ""
-    if not port.isdigit():
+    if not _PORT_RE.match(port):
         return ""
     
     # URL-encode user and password to handle special characters like <, >, ^, etc.
@@ -135,71 +186,367 @@ def get_connection(db_url: str):
     )
 
 
+def get_session_connection(db_url: str):
+    """Return this session's open connection for db_url, connecting if needed."""
+    cached = st.session_state.get("db_conn")
+    if cached and cached[0] == db_url:
+        return cached[1]
+    
+    close_session_connection()
+    conn = get_connection(db_url)
+    st.session_state["db_conn"] = (db_url, conn)
+    return conn
+
+
+def close_session_connection():
+    """Close and forget this session's cached connection."""
+    cached = st.session_state.pop("db_conn", None)
+    if cached:
+        try:
+            cached[1].close()
+        except Exception:
+            pass
+
+
+def build_dataframe(rows: list, pg_columns: list) -> pd.DataFrame:
+    """Build DataFrame from pg8000 rows, typing columns from their PostgreSQL OIDs."""
+    columns = [col['name'] for col in pg_columns]
+    # No coerce_float: NUMERIC values stay exact Decimals
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    
+    # Positional access keeps duplicate column names (e.g. a.id, b.id) intact
+    for i, col in enumerate(pg_columns):
+        dtype = PG_TYPE_DTYPES.get(col.get('type_oid'))
+        if dtype is None:
+            continue
+        values = df.iloc[:, i]
+        try:
+            if dtype == 'datetime64[ns]':
+                df.isetitem(i, pd.to_datetime(values))
+            elif dtype == 'datetimetz':
+                df.isetitem(i, pd.to_datetime(values, utc=True))
+            elif not values.isna().any():
+                # Columns with NULLs keep the inferred float64 representation
+                df.isetitem(i, values.astype(dtype))
+        except (ValueError, TypeError, OverflowError):
+            # Out-of-range values (e.g. 'infinity' timestamps) keep the inferred dtype
+            continue
+    
+    return df
+
+
+def limit_query(query: str, limit: int) -> str:
+    """Wrap query as a subquery so the server stops after `limit` rows."""
+    query = query.strip().rstrip('; \t\r\n')
+    # Newlines keep a trailing line comment from swallowing the closing parenthesis
+    return f"SELECT * FROM (\n{query}\n) AS __probe_sub LIMIT {limit}"
+
+
+def execute_query_arrow(db_url: str, query: str) -> pd.DataFrame:
+    """Execute SQL query with connectorx (binary COPY into Arrow buffers)."""
+    import connectorx as cx
+    
+    # Session settings can't be issued separately, so pass them as startup options
+    timeouts = quote(f"-c statement_timeout={QUERY_TIMEOUT_MS} -c lock_timeout=5000", safe='')
+    separator = '&' if urlparse(db_url).query else '?'
+    cx_url = f"{db_url}{separator}options={timeouts}"
+    
+    # Arrow output needs no COUNT(*) pre-query (pandas output does), so the
+    # query runs once, as a single COPY
+    return cx.read_sql(cx_url, query, return_type='arrow', protocol='binary').to_pandas()
+
+
+# connectorx error raised when it can't open a connection (the query hasn't run)
+_CX_CONNECT_ERROR = 'timed out waiting for connection'
+
+
+def _estimated_rows(conn, query: str) -> float:
+    """Planner row estimate for query (EXPLAIN only plans, nothing is executed)."""
+    plan = conn.run(f"EXPLAIN (FORMAT JSON) {query}")[0][0]
+    return plan[0]['Plan']['Plan Rows']
+
+
+def _sqlstate(error: Exception) -> str:
+    """SQLSTATE code of a pg8000 DatabaseError ('' if unavailable)."""
+    details = error.args[0] if error.args else None
+    return details.get('C', '') if isinstance(details, dict) else ''
+
+
+def get_query_connection(db_url: str):
+    """Return the session connection with query timeouts set, reconnecting once if stale."""
+    from pg8000.exceptions import InterfaceError
+    
+    for attempt in range(2):
+        conn = get_session_connection(db_url)
+        try:
+            # Set statement timeout for safety
+            conn.run(f"SET statement_timeout = '{QUERY_TIMEOUT_MS}'")
+            conn.run("SET lock_timeout = '5000'")
+            return conn
+        except InterfaceError:
+            # Idle connection was dropped by the server or a load balancer;
+            # nothing has run yet, so retry once on a fresh connection
+            close_session_connection()
+            if attempt:
+                raise
+        except Exception:
+            close_session_connection()
+            raise
+
+
+def run_query(conn, db_url: str, query: str, max_rows: int, limited_query: str = "") -> pd.DataFrame:
+    """
+    Run SQL query on a pg8000 connection, or through connectorx for large results.
+    
+    limited_query, if given, is used instead of query unless it can't be a
+    subquery, in which case the original text runs and its rows are sliced.
+    """
+    from pg8000.exceptions import DatabaseError
+    
+    if limited_query:
+        # Parse + describe only: validates the wrapped form and reports the
+        # result column types without executing anything
+        try:
+            statement = conn.prepare(limited_query)
+        except DatabaseError as e:
+            if _sqlstate(e) not in _UNWRAPPABLE_SQLSTATES:
+                raise
+            statement = None
+        
+        if statement is not None:
+            try:
+                # Fast path only for large results of types connectorx decodes
+                # like pg8000 does; its query errors are real and not retried
+                cols = statement.cols or []
+                if (cols and all(col['type_oid'] in CX_TYPE_OIDS for col in cols)
+                        and st.session_state.get("cx_failed_url") != db_url
+                        and _estimated_rows(conn, limited_query) >= CX_MIN_ROWS):
+                    try:
+                        return execute_query_arrow(db_url, limited_query)
+                    except ImportError:
+                        pass
+                    except RuntimeError as e:
+                        if not str(e).startswith(_CX_CONNECT_ERROR):
+                            raise
+                        # e.g. a pooler rejecting the startup options; the query
+                        # hasn't run, so use pg8000 (for the rest of the session)
+                        st.session_state["cx_failed_url"] = db_url
+                result = statement.run()
+                columns = statement.columns
+            finally:
+                statement.close()
+            
+            if result and columns:
+                return build_dataframe(result, columns)
+            return pd.DataFrame()
+    
+    result = conn.run(query)
+    if result and conn.columns:
+        return build_dataframe(result[:max_rows], conn.columns)
+    return pd.DataFrame()
+
+
 def execute_query(db_url: str, query: str) -> pd.DataFrame:
-    """Execute SQL query and return DataFrame."""
+    """Execute SQL query and return DataFrame (at most MAX_ROWS rows)."""
     # Validate query first
     is_valid, error_msg = validate_query(query)
     if not is_valid:
         raise ValueError(error_msg)
     
-    conn = get_connection(db_url)
+    # One extra row tells us whether the result was truncated
+    fetch_rows = MAX_ROWS + 1
+    
+    # SELECT/WITH queries get the limit pushed into SQL so excess rows are never sent
+    limited_query = limit_query(query, fetch_rows) if _SELECT_RE.match(query) else ""
+    
+    from pg8000.exceptions import DatabaseError
+    
+    conn = get_query_connection(db_url)
     try:
-        # Set statement timeout for safety
-        conn.run(f"SET statement_timeout = '{QUERY_TIMEOUT_MS}'")
-        conn.run("SET lock_timeout = '5000'")
-        
-        result = conn.run(query)
-        columns = [col['name'] for col in conn.columns] if conn.columns else []
+        df = run_query(conn, db_url, query, fetch_rows, limited_query)
         
-        if result and columns:
-            df = pd.DataFrame(result, columns=columns)
-            return df.head(MAX_ROWS)
-        return pd.DataFrame()
-    finally:
-        conn.close()
+        # Reset session state so the connection can be reused for the next query
+        try:
+            conn.run("DISCARD ALL")
+        except DatabaseError as e:
+            if _sqlstate(e) != _IN_TRANSACTION_SQLSTATE:
+                raise
+            # The query left a transaction open (e.g. BEGIN) - end it as a
+            # closed connection would, then reset
+            conn.run("ROLLBACK")
+            conn.run("DISCARD ALL")
+    except Exception:
+        # Connection may be broken or mid-transaction - reconnect next time
+        close_session_connection()
+        raise
+    
+    st.session_state["query_truncated"] = len(df) > MAX_ROWS
+    return df.head(MAX_ROWS)
 
 
 # =============================================================================
 # EXPORT FUNCTIONS
 # =============================================================================
+def _hash_dataframe(df: pd.DataFrame) -> tuple:
+    """Cache key for DataFrame arguments of cached export functions."""
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        # Unhashable cells (e.g. JSON arrays/objects) - hash their text form
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    # Digest of the hashes in row order, so a reordered result gets a new key
+    values_hash = hashlib.sha1(row_hashes.to_numpy().tobytes()).hexdigest()
+    return df.shape, tuple(df.columns), tuple(df.dtypes.astype(str)), values_hash
+
+
+# Exports are memoized so widget interactions don't re-serialize unchanged data
+_EXPORT_CACHE = dict(
+    ttl=600,
+    max_entries=4,
+    show_spinner=False,
+    hash_funcs={pd.DataFrame: _hash_dataframe, go.Figure: lambda fig: fig.to_json()},
+)
+
+
+# Cell value types the write-only worksheet accepts as-is
+_EXCEL_NATIVE_TYPES = (str, int, float, bool, Decimal, date, datetime, time, timedelta)
+
+
+def _excel_cell_value(value):
+    """Pass native Excel values through, stringify everything else."""
+    if value is None or isinstance(value, _EXCEL_NATIVE_TYPES):
+        return value
+    return str(value)
+
+
+@st.cache_data(**_EXPORT_CACHE)
 def generate_excel(df: pd.DataFrame) -> bytes:
     """Generate Excel file from DataFrame."""
+    import openpyxl
+    
     output = io.BytesIO()
-    export_df = df.head(MAX_EXPORT_ROWS).copy()
+    export_df = df.head(MAX_EXPORT_ROWS)
     
     # Fix timezone-aware datetimes (Excel doesn't support them)
-    for col in export_df.columns:
-        if pd.api.types.is_datetime64_any_dtype(export_df[col]):
-            if export_df[col].dt.tz is not None:
-                export_df[col] = export_df[col].dt.tz_localize(None)
+    tz_cols = export_df.select_dtypes(include=['datetimetz']).columns
+    if len(tz_cols):
+        # Copy only when there is something to convert
+        export_df = export_df.copy()
+        for col in tz_cols:
+            export_df[col] = export_df[col].dt.tz_localize(None)
+    
+    # Missing values become empty cells
+    object_cols = [i for i, dtype in enumerate(export_df.dtypes) if dtype == object]
+    export_df = export_df.astype(object).where(pd.notna(export_df), None)
+    
+    # Values openpyxl can't store (UUID, json dicts/lists, inet, ...) are written as text
+    for i in object_cols:
+        export_df.isetitem(i, export_df.iloc[:, i].map(_excel_cell_value))
+    
+    # Write-only workbook streams rows without building styled cell objects
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Data')
+    ws.append([str(c) for c in export_df.columns])
+    for row in export_df.itertuples(index=False, name=None):
+        ws.append(row)
+    wb.save(output)
+    
+    return output.getvalue()
+
+
+def _unique_column_names(columns) -> list[str]:
+    """Suffix repeated column names: id, id -> id, id.1."""
+    names, used = [], set()
+    for name in map(str, columns):
+        candidate, n = name, 0
+        while candidate in used:
+            n += 1
+            candidate = f"{name}.{n}"
+        used.add(candidate)
+        names.append(candidate)
+    return names
+
+
+def _arrow_convertible(values: pd.Series) -> bool:
+    """Whether pyarrow can convert the column as-is."""
+    import pyarrow as pa
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        export_df.to_excel(writer, index=False, sheet_name='Data')
+    try:
+        pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return False
+    return True
+
+
+@st.cache_data(**_EXPORT_CACHE)
+def generate_parquet(df: pd.DataFrame) -> bytes:
+    """Generate Parquet file from DataFrame."""
+    import pyarrow as pa
     
+    output = io.BytesIO()
+    export_df = df.head(MAX_EXPORT_ROWS)
+    
+    # Parquet requires unique column names (joins can return e.g. a.id, b.id)
+    if export_df.columns.has_duplicates:
+        export_df = export_df.set_axis(_unique_column_names(export_df.columns), axis=1)
+    
+    try:
+        export_df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Object columns pyarrow can't convert (inet, mixed json objects/arrays,
+        # dates next to 'infinity', ...) are written as text, like the Excel export
+        export_df = export_df.copy()
+        for i, dtype in enumerate(export_df.dtypes):
+            if dtype == object and not _arrow_convertible(export_df.iloc[:, i]):
+                values = export_df.iloc[:, i]
+                export_df.isetitem(i, values.astype(str).where(values.notna(), None))
+        output = io.BytesIO()
+        export_df.to_parquet(output, engine='pyarrow', compression='zstd', index=False)
     return output.getvalue()
 
 
+def figure_print_html(fig: go.Figure, include_plotlyjs, **layout) -> str:
+    """Render figure as an HTML fragment with temporary layout overrides."""
+    # Only the (small) layout is saved and restored; trace data is never copied
+    original_layout = fig.layout.to_plotly_json()
+    fig.update_layout(**layout)
+    try:
+        return fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs)
+    finally:
+        fig.layout = original_layout
+
+
+# Same replacements as html.escape(quote=True), applied in one C-level pass
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+
+@st.cache_data(**_EXPORT_CACHE)
 def generate_html_report(df: pd.DataFrame, chart_fig=None, map_fig=None, 
-                         report_name: str = "Data Report", description: str = "") -> str:
-    """Generate minimal print-friendly HTML report."""
+                         report_name: str = "Data Report", description: str = "",
+                         generated_at: str = "") -> str:
+    """
+    Generate minimal print-friendly HTML report.
+    
+    generated_at is passed in (rather than stamped here) so cached reports
+    don't carry a stale generation time.
+    """
     
     def escape(text):
-        return html.escape(str(text))
+        return str(text).translate(HTML_ESCAPE_TABLE)
     
-    # Build table HTML
-    table_rows = []
-    table_rows.append('<tr>' + ''.join(f'<th>{escape(c)}</th>' for c in df.columns) + '</tr>')
-    for _, row in df.head(500).iterrows():
-        table_rows.append('<tr>' + ''.join(f'<td>{escape(v)}</td>' for v in row) + '</tr>')
+    # Build table HTML (headers and cell values are escaped by pandas);
+    # str() keeps full float precision instead of display.precision rounding
+    table_html = df.head(500).to_html(index=False, escape=True, border=0, float_format=str)
     
-    table_html = f'<table>{"".join(table_rows)}</table>'
+    # Plotly JS is loaded from the CDN by the first figure only
+    include_plotlyjs = "cdn"
     
-    # Chart HTML
+    # Chart HTML - print colors applied temporarily (no copy of the trace data)
     chart_html = ""
     if chart_fig:
-        fig_dict = copy.deepcopy(chart_fig.to_dict())
-        chart_fig_print = go.Figure(fig_dict)
-        chart_fig_print.update_layout(
+        chart_plot = figure_print_html(
+            chart_fig,
+            include_plotlyjs,
             paper_bgcolor='white',
             plot_bgcolor='white',
             font=dict(color='black'),
@@ -208,24 +555,28 @@ def generate_html_report(df: pd.DataFrame, chart_fig=None, map_fig=None,
             yaxis=dict(color='black', gridcolor='#ddd', linecolor='#333'),
             legend=dict(font=dict(color='black'))
         )
-        chart_html = f'<div class="section section-chart"><h2>Chart</h2>{chart_fig_print.to_html(full_html=False, include_plotlyjs="cdn")}</div>'
+        chart_html = f'<div class="section section-chart"><h2>Chart</h2>{chart_plot}</div>'
+        include_plotlyjs = False
     
-    # Map HTML - use original map with light style
+    # Map HTML - original map with light style
     map_html = ""
     if map_fig:
-        map_fig.update_layout(
+        map_plot = figure_print_html(
+            map_fig,
+            include_plotlyjs,
             mapbox_style="carto-positron",
             paper_bgcolor='white'
         )
-        map_html = f'<div class="section section-map"><h2>Map</h2>{map_fig.to_html(full_html=False, include_plotlyjs="cdn")}</div>'
+        map_html = f'<div class="section section-map"><h2>Map</h2>{map_plot}</div>'
     
-    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
+    timestamp = generated_at or datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
     
     desc_html = ""
     if description:
         desc_html = f'<div class="description">{escape(description)}</div>'
     
-    return f'''<!DOCTYPE html>
+    out = io.StringIO()
+    out.write(f'''<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -267,11 +618,52 @@ def generate_html_report(df: pd.DataFrame, chart_fig=None, map_fig=None,
         <div class="meta">Generated: {timestamp} | Rows: {len(df):,}</div>
         {desc_html}
     </div>
-    <div class="section"><h2>Data</h2>{table_html}</div>
-    {chart_html}
-    {map_html}
-</body>
-</html>'''
+''')
+    # Large sections are written separately instead of being interpolated
+    out.write('    <div class="section"><h2>Data</h2>')
+    out.write(table_html)
+    out.write('</div>\n')
+    for section in (chart_html, map_html):
+        if section:
+            out.write(f'    {section}\n')
+    out.write('</body>\n</html>')
+    
+    return out.getvalue()
+
+
+def get_export_executor() -> ThreadPoolExecutor:
+    """This session's worker pool for building export files off the script thread."""
+    # Per session, so one user's large export never queues another user's
+    executor = st.session_state.get("export_executor")
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+        st.session_state["export_executor"] = executor
+    return executor
+
+
+def submit_export(slot: str, func, *args) -> Future:
+    """
+    Start func(*args) in the background, reusing the previous future for this
+    slot while the function and its arguments are unchanged (same objects,
+    equal strings).
+    """
+    futures = st.session_state.setdefault("export_futures", {})
+    previous = futures.get(slot)
+    if previous and previous[0] is func and len(previous[1]) == len(args) and all(
+        a is b or (isinstance(a, str) and a == b) for a, b in zip(previous[1], args)
+    ):
+        return previous[2]
+    
+    future = get_export_executor().submit(func, *args)
+    futures[slot] = (func, args, future)
+    return future
+
+
+# Download formats offered for the data table: label -> (generator, extension, MIME type)
+EXPORT_FORMATS = {
+    "Excel": (generate_excel, "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": (generate_parquet, "parquet", "application/vnd.apache.parquet"),
+}
 
 
 # =============================================================================
@@ -311,9 +703,9 @@ def render_sidebar():
         if st.button("Connect", type="primary", disabled=not db_url):
             with st.spinner("Connecting..."):
                 try:
-                    # Test connection
-                    conn = get_connection(db_url)
-                    conn.close()
+                    # Test with a new connection (kept open for subsequent queries)
+                    close_session_connection()
+                    get_session_connection(db_url)
                     st.session_state["db_url"] = db_url
                     st.session_state["connected"] = True
                     st.success("Connected")
@@ -324,9 +716,11 @@ def render_sidebar():
         if st.session_state.get("connected"):
             st.markdown("---")
             if st.button("Disconnect"):
+                close_session_connection()
                 st.session_state["connected"] = False
                 st.session_state["db_url"] = ""
                 st.session_state["query_result"] = None
+                st.session_state.pop("export_futures", None)
                 st.rerun()
 
 
@@ -357,6 +751,7 @@ def render_sql_editor():
     with col2:
         if st.button("Clear"):
             st.session_state["query_result"] = None
+            st.session_state.pop("export_futures", None)
             st.session_state["sql_query"] = ""
             st.rerun()
     
@@ -370,6 +765,7 @@ def render_sql_editor():
                 
                 st.session_state["query_result"] = df
                 st.session_state["sql_query"] = query
+                st.session_state["filter_options"] = {}
                 
                 st.markdown(f"""
                 <div class="success-msg">
@@ -378,6 +774,9 @@ def render_sql_editor():
                 </div>
                 """, unsafe_allow_html=True)
                 
+                if st.session_state.get("query_truncated"):
+                    st.warning(f"Result truncated to the first {MAX_ROWS:,} rows.")
+                
             except Exception as e:
                 st.markdown(f"""
                 <div class="error-msg">
@@ -387,7 +786,7 @@ def render_sql_editor():
 
 
 def render_data_table():
-    """Render data table with Excel export."""
+    """Render data table with Excel/Parquet export."""
     df = st.session_state.get("query_result")
     
     if df is None or df.empty:
@@ -397,20 +796,35 @@ def render_data_table():
     st.markdown("## Data Table")
     
     with st.expander("Filters"):
-        filter_cols = st.multiselect("Filter columns", options=df.columns.tolist())
+        filter_cols = st.multiselect("Filter columns", options=list(df.columns))
         filters = {}
+        # Option lists are computed once per query result (reset in render_sql_editor)
+        filter_options = st.session_state.setdefault("filter_options", {})
         for col in filter_cols:
-            unique_vals = df[col].dropna().unique().tolist()[:50]
+            if col not in filter_options:
+                filter_options[col] = df[col].drop_duplicates().dropna().head(50).tolist()
+            unique_vals = filter_options[col]
             selected = st.multiselect(f"{col}", unique_vals, key=f"filter_{col}")
             if selected:
                 filters[col] = selected
     
-    filtered_df = df.copy()
-    for col, vals in filters.items():
-        filtered_df = filtered_df[filtered_df[col].isin(vals)]
+    # Combine all filters into one mask so the frame is copied at most once
+    if filters:
+        mask = np.ones(len(df), dtype=bool)
+        for col, vals in filters.items():
+            mask &= df[col].isin(vals).to_numpy()
+        filtered_df = df.loc[mask]
+    else:
+        filtered_df = df
     
     st.session_state["filtered_df"] = filtered_df
     
+    # Start the export while the table is sent to the browser; only the
+    # selected format is serialized
+    export_format = st.session_state.get("export_format", next(iter(EXPORT_FORMATS)))
+    generate, extension, mime = EXPORT_FORMATS[export_format]
+    export_future = submit_export("data", generate, filtered_df)
+    
     col1, col2, col3 = st.columns(3)
     col1.metric("Rows", f"{len(filtered_df):,}")
     col2.metric("Columns", len(filtered_df.columns))
@@ -418,15 +832,36 @@ def render_data_table():
     
     st.dataframe(filtered_df, use_container_width=True, height=600)
     
-    excel_data = generate_excel(filtered_df)
+    st.radio(
+        "Export format",
+        options=list(EXPORT_FORMATS),
+        horizontal=True,
+        key="export_format"
+    )
+    try:
+        export_data = export_future.result()
+    except Exception as e:
+        st.error(f"Export error: {sanitize_error(e)}")
+        return
+    
     st.download_button(
-        label="Download Excel",
-        data=excel_data,
-        file_name=f"data_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        label=f"Download {export_format}",
+        data=export_data,
+        file_name=f"data_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}",
+        mime=mime
     )
 
 
+def with_categorical_color(df: pd.DataFrame, color, *axes) -> pd.DataFrame:
+    """Return df with a text color column as category dtype for faster trace grouping."""
+    # Numeric columns keep continuous color scales; axis columns keep their types
+    if color is None or color in axes or not (
+        pd.api.types.is_object_dtype(df[color]) or pd.api.types.is_string_dtype(df[color])
+    ):
+        return df
+    return df.assign(**{color: df[color].astype('category')})
+
+
 def render_chart():
     """Render chart section."""
     df = st.session_state.get("filtered_df")
@@ -437,7 +872,7 @@ def render_chart():
     st.markdown("---")
     st.markdown("## Chart")
     
-    all_cols = df.columns.tolist()
+    all_cols = list(df.columns)
     
     if not all_cols:
         st.info("No columns available for charting.")
@@ -456,7 +891,7 @@ def render_chart():
         try:
             color = None if color_by == "None" else color_by
             fig = px.line(
-                df,
+                with_categorical_color(df, color, x_axis, y_axis),
                 x=x_axis,
                 y=y_axis,
                 color=color,
@@ -477,36 +912,9 @@ def render_chart():
 
 def calculate_map_zoom(lat_min, lat_max, lon_min, lon_max):
     """Calculate appropriate zoom level based on coordinate bounds."""
-    lat_span = lat_max - lat_min
-    lon_span = lon_max - lon_min
-    max_span = max(lat_span, lon_span)
-    
-    if max_span > 100:
-        return 1
-    elif max_span > 50:
-        return 2
-    elif max_span > 20:
-        return 3
-    elif max_span > 10:
-        return 4
-    elif max_span > 5:
-        return 5
-    elif max_span > 2:
-        return 6
-    elif max_span > 1:
-        return 7
-    elif max_span > 0.5:
-        return 8
-    elif max_span > 0.2:
-        return 9
-    elif max_span > 0.1:
-        return 10
-    elif max_span > 0.05:
-        return 11
-    elif max_span > 0.01:
-        return 12
-    else:
-        return 13
+    max_span = max(lat_max - lat_min, lon_max - lon_min)
+    # Each span threshold exceeded zooms out one level from the closest zoom (13)
+    return MAP_MAX_ZOOM - bisect.bisect_left(MAP_ZOOM_SPANS, max_span)
 
 
 def render_map():
@@ -519,7 +927,7 @@ def render_map():
     st.markdown("---")
     st.markdown("## Map")
     
-    all_cols = df.columns.tolist()
+    all_cols = list(df.columns)
     
     lat_patterns = ['lat', 'latitude', 'y']
     lon_patterns = ['lon', 'lng', 'longitude', 'x']
@@ -540,14 +948,24 @@ def render_map():
     
     if st.button("Generate Map"):
         try:
-            map_df = df.copy()
-            map_df[lat_col] = pd.to_numeric(map_df[lat_col], errors='coerce')
-            map_df[lon_col] = pd.to_numeric(map_df[lon_col], errors='coerce')
-            map_df = map_df.dropna(subset=[lat_col, lon_col])
+            # Sample before coercion; oversample so rows with invalid coordinates
+            # don't usually leave fewer than MAP_MAX_POINTS (it is an upper bound)
+            points_df = df
+            sampled = len(df) > MAP_MAX_POINTS
+            if sampled:
+                rng = np.random.default_rng(42)
+                sample_size = min(len(df), int(MAP_MAX_POINTS * 1.1))
+                points_df = df.iloc[rng.choice(len(df), sample_size, replace=False)]
+            
+            # Coerce only the coordinate columns instead of copying the whole frame
+            lat = pd.to_numeric(points_df[lat_col], errors='coerce')
+            lon = pd.to_numeric(points_df[lon_col], errors='coerce')
+            valid = lat.notna() & lon.notna()
+            map_df = points_df.loc[valid].assign(**{lat_col: lat[valid], lon_col: lon[valid]})
+            map_df = map_df.head(MAP_MAX_POINTS)
             
-            if len(map_df) > 5000:
-                map_df = map_df.sample(n=5000, random_state=42)
-                st.warning("Sampled to 5,000 points for performance.")
+            if sampled:
+                st.warning(f"Sampled to {MAP_MAX_POINTS:,} points for performance.")
             
             if len(map_df) == 0:
                 st.warning("No valid coordinates found.")
@@ -563,7 +981,7 @@ def render_map():
             
             color = None if color_col == "None" else color_col
             fig = px.scatter_mapbox(
-                map_df,
+                with_categorical_color(map_df, color, lat_col, lon_col),
                 lat=lat_col,
                 lon=lon_col,
                 color=color,
@@ -651,12 +1069,15 @@ def render_html_export():
     # Prepare final values
     final_description = report_desc.strip() if report_desc else ""
     
-    html_report = generate_html_report(
+    report_future = submit_export(
+        "report",
+        generate_html_report,
         df, 
         chart_fig, 
         map_fig, 
-        report_name=final_report_name,
-        description=final_description
+        final_report_name,
+        final_description,
+        datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
     )
     
     # Show preview of what will be in the report
@@ -668,7 +1089,7 @@ def render_html_export():
     
     st.download_button(
         label="Download HTML Report",
-        data=html_report,
+        data=report_future.result(),
         file_name=f"{safe_filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
         mime="text/html"
     )